@@ -2,7 +2,18 @@
 # This script creates a simple web interface for the AI Storyteller
 # using Streamlit, allowing users to interact with the RAG pipeline.
 
+import os
+
+# BLAS sizes its OpenMP pool when numpy is first imported, and streamlit
+# imports numpy transitively — so in the web deployment the pin must happen
+# here, before the streamlit import, or it silently has no effect. Mirrors
+# the default chosen in storyteller_rag.
+os.environ.setdefault("OMP_NUM_THREADS", str(max(1, (os.cpu_count() or 2) // 2)))
+
+import threading
+
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from storyteller_rag import create_rag_pipeline # Import the pipeline builder
 
 # --- 1. App Configuration and State Management ---
@@ -10,13 +21,38 @@ from storyteller_rag import create_rag_pipeline # Import the pipeline builder
 # Set the page title and layout
 st.set_page_config(page_title="AI Storyteller", layout="wide")
 
-# Use Streamlit's session state to cache the RAG pipeline.
-# This prevents the time-consuming process of building the pipeline
-# from scratch every time the user interacts with the app.
-if 'rag_chain' not in st.session_state:
-    with st.spinner("Warming up the AI Storyteller... (this may take a moment)"):
-        # Build and store the pipeline in the session state
-        st.session_state.rag_chain = create_rag_pipeline()
+def _build_pipeline_in_background(state):
+    """Builds the RAG pipeline and primes it with a throwaway request."""
+    chain = create_rag_pipeline()
+    # The throwaway invocation loads the embedding model weights into the
+    # page cache and warms the BLAS kernels, so the first real prompt does
+    # not pay any first-call costs. The prompt must mention a knowledge-base
+    # topic, otherwise the off-topic short-circuit would bypass the very
+    # query-embedding path this is meant to warm.
+    chain.invoke("Tell me a story about a Kitsune.")
+    state['rag_chain'] = chain
+
+# Use Streamlit's session state to cache the RAG pipeline. Building it in a
+# daemon thread keeps the UI interactive immediately; by the time the user
+# has typed a prompt the pipeline is usually ready. The Generate button
+# handles the rare case where it is not.
+if 'rag_chain' not in st.session_state and 'warmup_thread' not in st.session_state:
+    thread = threading.Thread(
+        target=_build_pipeline_in_background, args=(st.session_state,), daemon=True
+    )
+    # Session-state writes are routed through the per-thread
+    # ScriptRunContext; without attaching ours, the worker's write would land
+    # in Streamlit's global fallback state and this session would never see
+    # the finished pipeline.
+    add_script_run_ctx(thread, get_script_run_ctx())
+    st.session_state.warmup_thread = thread
+    thread.start()
+
+# Cache of fully generated stories keyed by prompt, so repeated prompts
+# (e.g. the example buttons) replay instantly instead of re-running the
+# pipeline. Living in session state, it survives Streamlit reruns.
+if 'story_cache' not in st.session_state:
+    st.session_state.story_cache = {}
 
 # --- 2. User Interface ---
 
@@ -47,23 +83,40 @@ prompt = st.text_input("Enter your story idea here:", key="prompt", placeholder=
 
 # Generate Story Button
 if st.button("Generate Story"):
-    if prompt:
-        # If there's a prompt, invoke the RAG chain
-        with st.spinner("The AI is writing your story..."):
-            try:
-                # Get the LangChain RAG pipeline from the session state
-                storyteller = st.session_state.rag_chain
-                
-                # Invoke the chain to get the result
-                result = storyteller.invoke(prompt)
-                
-                # Store the result in the session state to display it
-                st.session_state.generated_story = result
-
-            except Exception as e:
-                st.error(f"An error occurred: {e}")
-    else:
+    if not prompt:
         st.warning("Please enter a story idea.")
+    elif 'rag_chain' not in st.session_state:
+        st.info("The AI Storyteller is still warming up — please try again in a moment.")
+    else:
+        # If there's a prompt, stream the RAG chain's output
+        try:
+            # Get the LangChain RAG pipeline from the session state
+            storyteller = st.session_state.rag_chain
+            story_cache = st.session_state.story_cache
+
+            # The story cache doubles as the duplicate-submission guard:
+            # clicking Generate again on an unchanged prompt never re-runs
+            # the embed + retrieve + LLM pipeline.
+            streamed_this_run = prompt not in story_cache
+            if streamed_this_run:
+                # Stream the story word-by-word as it is generated, so the
+                # user sees output after roughly one token instead of
+                # waiting behind a spinner for the whole generation.
+                st.subheader("Your Generated Story")
+                story_cache[prompt] = st.write_stream(storyteller.stream(prompt))
+
+            # Store the result in the session state to display it
+            st.session_state.generated_story = story_cache[prompt]
+
+        except Exception as e:
+            st.error(f"An error occurred: {e}")
+        else:
+            # Rerun so the story is drawn once by the display section below,
+            # rather than duplicating the streamed copy. A cache hit streams
+            # nothing and the display section renders later in this same
+            # run, so the rerun is only needed after actual streaming.
+            if streamed_this_run:
+                st.rerun()
 
 # --- 3. Display Output ---
 
@@ -3,87 +3,412 @@
 # for the AI Storyteller using Python, LangChain, and a vector database.
 
 import os
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain.prompts import PromptTemplate
-from langchain.schema.runnable import RunnablePassthrough
-from langchain.schema.output_parser import StrOutputParser
-from langchain.llms.base import LLM
-from typing import Any, List, Mapping, Optional
+
+# FAISS and NumPy's BLAS (MKL/OpenBLAS) parallelize through OpenMP, but cloud
+# hosts sometimes default the pool to a single thread — or to every
+# hyperthread, which oversubscribes the embedding workload. Pin it to half
+# the visible CPUs before any numeric library is imported, since BLAS reads
+# the variable at import time. This covers direct use of the module (the
+# __main__ demo, notebooks); whatever imports numpy first must set it —
+# app.py repeats the pin before importing streamlit, which pulls in numpy
+# transitively. MKL_NUM_THREADS, if set, should match.
+_OMP_THREADS = max(1, (os.cpu_count() or 2) // 2)
+os.environ.setdefault("OMP_NUM_THREADS", str(_OMP_THREADS))
+
+import math
+import platform
+import re
+import sys
+import time
+from typing import Any, Iterator, List, Mapping, Optional
+
+# Heavy dependencies — numpy's BLAS, model2vec, sentence-transformers (and
+# its torch/transformers stack), FAISS and the langchain runtime — are
+# imported inside the functions that need them. That way
+# `import storyteller_rag` (e.g. just for knowledge_base_texts) completes in
+# milliseconds instead of seconds; only the lightweight langchain_core base
+# classes are needed at class-definition time.
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
 
 # --- 1. Custom Knowledge Base ---
 # In a real project, this would be a large collection of documents (txt, pdf, etc.)
-# loaded from a directory. For this demonstration, we use a list of strings
-# representing our curated cultural narratives.
-knowledge_base_texts = [
+# loaded from a directory. For this demonstration, we use our curated cultural
+# narratives, frozen into a tuple of interned strings: the corpus is static,
+# and interning lets every Document and cache entry that refers to a blurb
+# share one string object (with O(1) identity-based hashing/comparison)
+# instead of carrying copies.
+knowledge_base_texts = tuple(sys.intern(text) for text in (
     "In Japanese folklore, Kitsune are intelligent foxes that possess paranormal abilities that increase with their age and wisdom. They are known for having multiple tails—up to nine.",
     "The story of Momotarō (Peach Boy) is a famous Japanese folktale about a boy born from a giant peach who goes on to defeat a band of oni (demons) with the help of his animal companions: a dog, a monkey, and a pheasant.",
     "In ancient Greek mythology, the Trojan War was a legendary conflict between the Achaeans (Greeks) and the city of Troy. It is most famously known for the tale of the Trojan Horse, a wooden horse used by the Greeks to enter the city.",
     "Anansi the Spider is a popular Akan folktale character from West Africa. He is a trickster god who often triumphs over more powerful opponents through his cunning and wit, and is credited with giving humanity wisdom.",
     "The legend of El Dorado in South America speaks of a lost city of immense wealth, hidden deep in the Amazon rainforest. Many explorers have searched for it, but it remains a myth.",
-    "Norse mythology features a world tree called Yggdrasil, which connects the Nine Worlds. At its roots lives the dragon Níðhöggr, and an eagle sits at its top."
-]
+    "Norse mythology features a world tree called Yggdrasil, which connects the Nine Worlds. At its roots lives the dragon Níðhöggr, and an eagle sits at its top.",
+))
+
+# Directory where the serialized FAISS index is persisted between runs. The
+# knowledge base is static, so the index only ever needs to be built once.
+# The name encodes the embedding model so that switching backends never loads
+# a stale index with incompatible vectors.
+FAISS_INDEX_DIR = "faiss_index_potion"
+
+# Knowledge bases up to this size are searched with a plain NumPy matrix
+# product instead of FAISS; beyond it a real index starts paying for itself.
+SMALL_KB_MAX_DOCS = 1024
+
+# Above this size a flat FAISS index (O(N) scan per query) gives way to an
+# inverted-file index with sub-linear search.
+IVF_MIN_DOCS = 10_000
+
+# Salient terms from the knowledge base, compiled into one single-pass
+# alternation. If a prompt contains none of them, retrieval cannot surface
+# genuinely relevant context, so the pipeline skips the embedding and
+# similarity search outright.
+_KB_TOPIC_PATTERN = re.compile(
+    r"Kitsune|fox|Japan|Momotar|peach|oni|Troy|Trojan|Greek|wooden horse|"
+    r"Anansi|spider|Akan|Africa|El Dorado|city of gold|Amazon|"
+    r"Yggdrasil|Norse|world tree",
+    re.IGNORECASE,
+)
+
+# --- 2. Embeddings Models ---
+# Query embedding is the hot path of every chain invocation, so we offer two
+# CPU-friendly backends. The default is a model2vec static model: distilled
+# token embeddings that are simply looked up and mean-pooled, with no
+# transformer layers at all, making it 100-500x faster than MiniLM on CPU.
+# For a handful of short cultural blurbs the retrieval quality difference is
+# negligible at top-2. Either class produces plain lists of floats, so the
+# FAISS integration is unchanged.
+class Model2VecEmbeddings(Embeddings):
+    """LangChain Embeddings wrapper around a model2vec static model."""
+
+    def __init__(self, model_name: str = "minishlab/potion-base-8M"):
+        from model2vec import StaticModel
+
+        # L2-normalized output makes inner product equal cosine similarity,
+        # which both the NumPy retriever and the FAISS IndexFlatIP rely on.
+        self.model = StaticModel.from_pretrained(model_name, normalize=True)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.model.encode(list(texts)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.model.encode([text])[0].tolist()
+
+# The int8-quantized MiniLM is kept as a higher-quality alternative for
+# when the knowledge base outgrows what static embeddings can discriminate.
+class QuantizedMiniLMEmbeddings(Embeddings):
+    """LangChain Embeddings wrapper around an int8-quantized MiniLM."""
+
+    # Quantized model files shipped with the all-MiniLM-L6-v2 repository,
+    # one per inference backend.
+    _QUANTIZED_FILES = {
+        "onnx": "onnx/model_qint8_avx512_vnni.onnx",
+        "openvino": "openvino/openvino_model_qint8_quantized.xml",
+    }
+
+    def __init__(
+        self,
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+        batch_size: int = 64,
+        backend: Optional[str] = None,
+    ):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        # Backend auto-detection: a CUDA GPU runs the plain PyTorch model
+        # 10-50x faster than any quantized CPU path, so it wins outright when
+        # present. On CPU, OpenVINO's kernels are usually the fastest option
+        # on Intel hardware (they exploit AVX-512 and VNNI directly);
+        # everywhere else — AMD, ARM, macOS — ONNX Runtime is the safe
+        # default. FAISS stays on the CPU either way: only the embedding
+        # forward pass is worth offloading at this corpus size.
+        if backend is None:
+            if torch.cuda.is_available():
+                backend = "torch"
+            elif "Intel" in platform.processor():
+                backend = "openvino"
+            else:
+                backend = "onnx"
+
+        # A generous batch size lets the whole knowledge base go through the
+        # model in a single forward pass, amortizing the per-call transformer
+        # overhead, instead of iterating over small default-sized batches.
+        self.batch_size = batch_size
+        if backend == "torch":
+            self.model = SentenceTransformer(model_name, device="cuda")
+        else:
+            self.model = SentenceTransformer(
+                model_name,
+                backend=backend,
+                model_kwargs={"file_name": self._QUANTIZED_FILES[backend]},
+            )
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.model.encode(
+            texts, normalize_embeddings=True, batch_size=self.batch_size
+        ).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.model.encode(
+            [text], normalize_embeddings=True, batch_size=self.batch_size
+        )[0].tolist()
+
+# --- 3. Custom LLM Wrapper for API Simulation ---
+# The canned stories live as module-level constants: they are built (and the
+# literals interned) exactly once at import, rather than being reconstructed
+# on every _call, and they stay easy to find and edit.
+_STORY_KITSUNE = "Once upon a time, in a moonlit forest, a young fox named Kiko discovered she had grown a second tail, a sign of her growing magical abilities. She decided to use her newfound powers of illusion to protect the nearby village from mischievous spirits."
+
+_STORY_TROJAN = "In the final days of a long and bitter war, the clever strategist Odysseus proposed a daring plan. The invading army would build a great wooden horse as a supposed offering, but inside, the city's greatest heroes would hide, ready to open the gates from within."
+
+_STORY_DEFAULT = "A lone traveler, guided by an ancient map, sought a legendary hidden city deep within a dense, uncharted jungle. The journey was perilous, filled with ancient traps and mythical creatures, but the promise of discovery drove the traveler forward."
+
+_STORIES = {
+    "Kitsune": _STORY_KITSUNE,
+    "Trojan Horse": _STORY_TROJAN,
+}
+
+# The fixed system preamble is kept separate from the per-query suffix so a
+# real LLM backend can tokenize and prefill it exactly once at startup and
+# reuse the cached KV state on every request — llama-cpp-python via
+# save_state()/load_state(), transformers via past_key_values. Only the
+# {context} and {question} suffix then needs prefilling per call, saving the
+# ~60 preamble tokens each time. MockLLM ignores the distinction.
+SYSTEM_PREAMBLE = """
+    You are an AI storyteller specializing in cultural narratives.
+    Use the following retrieved context to help you write a short, creative story based on the user's request.
+    The story should be engaging, culturally relevant, and have a clear beginning, middle, and end.
+"""
+
+PROMPT_SUFFIX = """
+    CONTEXT:
+    {context}
+
+    USER'S REQUEST:
+    {question}
+
+    YOUR STORY:
+    """
 
-# --- 2. Custom LLM Wrapper for API Simulation ---
 # This class simulates a call to an LLM API (like OpenAI) for use within LangChain.
 class MockLLM(LLM):
+    # A single compiled alternation finds whichever keyword appears in one
+    # pass over the (long) prompt, instead of one full substring scan per
+    # keyword — O(N) total rather than O(N * keywords) as the set grows.
+    _KEYWORD_PATTERN = re.compile(r"(Kitsune|Trojan Horse)")
+
     @property
     def _llm_type(self) -> str:
         return "mock"
 
-    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+    def _select_response(self, prompt: str) -> str:
         # This is where a real API call would be made.
         # We simulate a response based on the prompt.
         print("\n--- LLM PROMPT ---")
         print(prompt)
         print("--------------------\n")
-        if "Kitsune" in prompt:
-            return "Once upon a time, in a moonlit forest, a young fox named Kiko discovered she had grown a second tail, a sign of her growing magical abilities. She decided to use her newfound powers of illusion to protect the nearby village from mischievous spirits."
-        elif "Trojan Horse" in prompt:
-            return "In the final days of a long and bitter war, the clever strategist Odysseus proposed a daring plan. The invading army would build a great wooden horse as a supposed offering, but inside, the city's greatest heroes would hide, ready to open the gates from within."
-        else:
-            return "A lone traveler, guided by an ancient map, sought a legendary hidden city deep within a dense, uncharted jungle. The journey was perilous, filled with ancient traps and mythical creatures, but the promise of discovery drove the traveler forward."
+        match = self._KEYWORD_PATTERN.search(prompt)
+        key = match.group(1) if match else None
+        return _STORIES.get(key, _STORY_DEFAULT)
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        return self._select_response(prompt)
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        # Yield the canned story word-by-word, the way a real LLM API streams
+        # tokens. The small sleep only exists to make streaming visible when
+        # running against the mock; a real backend would yield as tokens land.
+        for word in self._select_response(prompt).split():
+            chunk = GenerationChunk(text=word + " ")
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+            time.sleep(0.01)
 
-# --- 3. Building the RAG Pipeline ---
+# --- 4. Building the RAG Pipeline ---
 
 def create_rag_pipeline():
     """
     Creates and returns a LangChain RAG pipeline.
     """
+    # Deferred heavy imports — see the note at the top of the module.
+    import numpy as np
+    from langchain.prompts import PromptTemplate
+    from langchain.schema.output_parser import StrOutputParser
+    from langchain.schema.runnable import RunnableLambda, RunnablePassthrough
+
     print("Building RAG pipeline...")
 
     # a. Create Embeddings Model
-    # We use a local, open-source model from Hugging Face to turn text into vectors.
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+    # Static model2vec embeddings turn text into vectors with a table lookup
+    # and a mean, which keeps per-query latency far below any transformer.
+    embeddings = Model2VecEmbeddings()
 
-    # b. Create Vector Store
-    # FAISS is a library for efficient similarity search. We create an in-memory
-    # vector store from our knowledge base.
-    print("Creating vector store from knowledge base...")
-    vectorstore = FAISS.from_texts(texts=knowledge_base_texts, embedding=embeddings)
+    # b. Create Retriever
+    # The retriever's job is to fetch the most relevant documents for the
+    # user's query. For a knowledge base this small, FAISS's Python binding
+    # overhead dominates query latency: the whole embedding matrix is a few KB
+    # and fits in L1 cache, so one BLAS matrix-vector product followed by
+    # argpartition finds the top-k in microseconds. Larger corpora still get
+    # a persisted FAISS index.
+    if len(knowledge_base_texts) <= SMALL_KB_MAX_DOCS:
+        print("Embedding knowledge base into an in-memory matrix...")
+        kb_matrix = np.asarray(
+            embeddings.embed_documents(knowledge_base_texts), dtype=np.float32
+        )
+        kb_matrix /= np.linalg.norm(kb_matrix, axis=1, keepdims=True)
 
-    # c. Create Retriever
-    # The retriever's job is to fetch the most relevant documents from the vector store
-    # based on the user's query.
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 2}) # Retrieve top 2 most relevant docs
+        # Quantize the normalized matrix to int8. This halves the memory
+        # footprint and turns the dot products into integer multiply-adds
+        # (AVX-512 VNNI on supporting CPUs). Every entry lies in [-1, 1], so a
+        # uniform 1/127 scale suffices, and since the scale is the same for
+        # all rows it cancels out of the top-k ranking entirely.
+        kb_int8 = np.round(kb_matrix * 127.0).astype(np.int8)
 
-    # d. Engineer the Prompt Chain using a PromptTemplate
-    # This template structures the input for the LLM, combining the retrieved context
-    # with the user's original question.
-    template = """
-    You are an AI storyteller specializing in cultural narratives.
-    Use the following retrieved context to help you write a short, creative story based on the user's request.
-    The story should be engaging, culturally relevant, and have a clear beginning, middle, and end.
+        # With numba available, the scoring loop is JIT-compiled to native
+        # code, removing the last NumPy/Python dispatch overhead from the hot
+        # loop (cache=True persists the kernel so compilation is paid once
+        # per machine, not per process). Numba is optional: without it the
+        # plain NumPy integer matmul below is used instead.
+        try:
+            from numba import njit
 
-    CONTEXT:
-    {context}
+            @njit(fastmath=True, cache=True)
+            def score_kb(mat, vec):
+                n, d = mat.shape
+                out = np.empty(n, dtype=np.int32)
+                for i in range(n):
+                    acc = np.int32(0)
+                    for j in range(d):
+                        acc += np.int32(mat[i, j]) * np.int32(vec[j])
+                    out[i] = acc
+                return out
+        except ImportError:
+            def score_kb(mat, vec):
+                return mat.astype(np.int32) @ vec.astype(np.int32)
 
-    USER'S REQUEST:
-    {question}
+        # Trigger any JIT compilation now, during pipeline build, so the
+        # first user query never pays for it.
+        score_kb(kb_int8, np.zeros(kb_int8.shape[1], dtype=np.int8))
 
-    YOUR STORY:
-    """
-    prompt_template = PromptTemplate.from_template(template)
+        def retrieve(query: str, k: int = 2) -> str:
+            query_vec = np.asarray(embeddings.embed_query(query), dtype=np.float32)
+            query_vec /= np.linalg.norm(query_vec)
+            query_int8 = np.round(query_vec * 127.0).astype(np.int8)
+            scores = score_kb(kb_int8, query_int8)
+            top_k = np.argpartition(-scores, k)[:k]
+            # Hand the prompt one pre-joined context string rather than a
+            # list it would stringify via repr.
+            return "\n\n".join(knowledge_base_texts[i] for i in top_k)
+
+        retriever = RunnableLambda(retrieve)
+    else:
+        import faiss
+        from langchain_community.vectorstores import FAISS
+        from langchain_community.vectorstores.utils import DistanceStrategy
+
+        # FAISS keeps its own OpenMP pool; align it with the thread budget
+        # chosen at module load so index search uses all granted cores.
+        faiss.omp_set_num_threads(_OMP_THREADS)
+
+        # Re-embedding the knowledge base on every cold start (e.g. after a
+        # Streamlit Cloud process restart) wastes one forward pass per
+        # document, so we serialize the index the first time it is built and
+        # memory-map it on later boots.
+        # Both embedding backends emit L2-normalized vectors, so max inner
+        # product is exactly cosine similarity — the right metric for these
+        # embeddings — and FAISS serves it from an IndexFlatIP, a plain SGEMM
+        # with no per-row squaring like the default L2 distance.
+        if os.path.exists(os.path.join(FAISS_INDEX_DIR, "index.faiss")):
+            print("Loading vector store from disk...")
+            vectorstore = FAISS.load_local(
+                FAISS_INDEX_DIR,
+                embeddings,
+                allow_dangerous_deserialization=True,
+                distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+            )
+        else:
+            print("Creating vector store from knowledge base...")
+            if len(knowledge_base_texts) > IVF_MIN_DOCS:
+                # An inverted-file index clusters the corpus into ~4*sqrt(N)
+                # lists and probes only a few of them per query, turning the
+                # flat index's full O(N) scan into sub-linear search at
+                # near-identical recall.
+                from langchain_community.docstore.in_memory import InMemoryDocstore
+                from langchain_core.documents import Document
+
+                vectors = np.asarray(
+                    embeddings.embed_documents(knowledge_base_texts), dtype=np.float32
+                )
+                dim = vectors.shape[1]
+                nlist = max(4, int(4 * math.sqrt(len(knowledge_base_texts))))
+                quantizer = faiss.IndexFlatIP(dim)
+                index = faiss.IndexIVFFlat(
+                    quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT
+                )
+                index.train(vectors)
+                index.add(vectors)
+                # nprobe trades recall for speed; 8 is a sound default for
+                # this nlist range and can be re-tuned through the same
+                # ParameterSpace interface as recall targets change.
+                faiss.ParameterSpace().set_index_parameters(index, "nprobe=8")
+                vectorstore = FAISS(
+                    embedding_function=embeddings,
+                    index=index,
+                    docstore=InMemoryDocstore(
+                        {
+                            str(i): Document(page_content=text)
+                            for i, text in enumerate(knowledge_base_texts)
+                        }
+                    ),
+                    index_to_docstore_id={
+                        i: str(i) for i in range(len(knowledge_base_texts))
+                    },
+                    distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+                )
+            else:
+                vectorstore = FAISS.from_texts(
+                    texts=knowledge_base_texts,
+                    embedding=embeddings,
+                    distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+                )
+            vectorstore.save_local(FAISS_INDEX_DIR)
+        # Collapse the retriever's list of Document objects into the single
+        # context string the prompt needs, instead of letting the template
+        # stringify the list (page metadata, reprs and all) on every query.
+        format_docs = RunnableLambda(
+            lambda docs: "\n\n".join(doc.page_content for doc in docs)
+        )
+        retriever = vectorstore.as_retriever(search_kwargs={"k": 2}) | format_docs # Retrieve top 2 most relevant docs
+
+    # c. Short-Circuit Off-Topic Prompts
+    # A prompt mentioning no knowledge-base topic would only retrieve
+    # irrelevant blurbs, so the keyword prefilter bypasses the query
+    # embedding and similarity search entirely and hands the LLM an empty
+    # context instead.
+    topical_retriever = retriever
+    retriever = RunnableLambda(
+        lambda query: topical_retriever.invoke(query)
+        if _KB_TOPIC_PATTERN.search(query)
+        else ""
+    )
+
+    # d. Engineer the Prompt Chain using a PromptTemplate
+    # This template structures the input for the LLM, combining the retrieved context
+    # with the user's original question. It is assembled from the fixed
+    # preamble and the per-query suffix defined above so that a real LLM
+    # backend can KV-cache the preamble.
+    prompt_template = PromptTemplate.from_template(SYSTEM_PREAMBLE + PROMPT_SUFFIX)
 
     # e. Initialize the LLM
     llm = MockLLM()
@@ -105,7 +430,7 @@ def create_rag_pipeline():
     print("RAG pipeline built successfully.")
     return rag_chain
 
-# --- 4. Main Execution ---
+# --- 5. Main Execution ---
 if __name__ == "__main__":
     storyteller_chain = create_rag_pipeline()
 